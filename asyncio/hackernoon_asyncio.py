@@ -137,3 +137,167 @@ async def web_server_handler():
 
 loop = asyncio.get_event_loop()
 loop.run_until_complete(asyncio.ensure_future(web_server_handler()))
+
+# Deadlines, cancellation and hedged requests
+
+# web_server_handler above waits on asyncio.wait([task1, task2]) with no
+# timeout, so the handler is exactly as slow as the slowest network call.
+# If one of them hangs, so does the handler -- and whoever called it.
+
+# A DEADLINE is a point in time by which the whole handler has to answer.
+# It is stored in a context variable: every task created with ensure_future
+# or create_task gets a copy of the current context, so the deadline flows
+# down to every network call the handler makes without being passed around
+# as an argument.  Each call waits only for the time that is left, and
+# whatever hasn't finished by the deadline is cancelled -- cancelling a task
+# raises CancelledError inside it at the await it is paused on.  The handler
+# then answers with the partial results it has.
+
+# A HEDGED REQUEST deals with the slow tail.  Most calls are quick, but a few
+# take far longer (a GC pause, a lost packet, a busy replica).  If a call
+# hasn't come back by the time 95% of calls normally have, send the same
+# request again and take whichever answer arrives first, cancelling the
+# other.  Only about 5% of calls get a duplicate, so the extra load is small,
+# but a slow call no longer means a slow answer.
+
+import collections
+import contextvars
+import random
+
+deadline = contextvars.ContextVar('deadline', default=None)
+
+# hedges_fired, hedges_won, deadline_cancellations and request_failures
+stats = collections.Counter()
+
+def time_left():
+    # None means there is no deadline
+    when = deadline.get()
+    if when is None:
+        return None
+    return max(0.0, when - asyncio.get_event_loop().time())
+
+class LatencyTracker:
+    # Remembers the last few latencies, so the hedge delay follows how the
+    # network is behaving right now
+    def __init__(self, size=100, percentile=95, default=0.2):
+        self.samples = collections.deque(maxlen=size)
+        self.percentile = percentile
+        self.default = default
+
+    def record(self, latency):
+        self.samples.append(latency)
+
+    def hedge_delay(self):
+        # Until there are enough samples to trust, use a fixed delay
+        if len(self.samples) < 20:
+            return self.default
+        ordered = sorted(self.samples)
+        return ordered[int(len(ordered) * self.percentile / 100)]
+
+latencies = LatencyTracker()
+
+# this is a coroutine definition
+async def flaky_network_request(request):
+    # like fake_network_request, but one call in ten is very slow
+    delay = 2 if random.random() < 0.1 else random.uniform(0.05, 0.15)
+    start = asyncio.get_event_loop().time()
+    await asyncio.sleep(delay)
+    latencies.record(asyncio.get_event_loop().time() - start)
+    return 'got network response for request:   ' + request
+
+async def hedged(request, hedge=True):
+    loop = asyncio.get_event_loop()
+    first = loop.create_task(flaky_network_request(request))
+    tasks = {first}
+    try:
+        if hedge:
+            delay = latencies.hedge_delay()
+            left = time_left()
+            if left is None or delay < left:
+                # asyncio.wait does not cancel anything when it times out,
+                # the first request keeps running
+                await asyncio.wait(tasks, timeout=delay)
+                if not first.done():
+                    print('hedging request:   ' + request)
+                    stats['hedges_fired'] += 1
+                    tasks.add(loop.create_task(flaky_network_request(request)))
+
+        done, _ = await asyncio.wait(tasks, timeout=time_left(),
+                                     return_when=asyncio.FIRST_COMPLETED)
+        if not done:
+            raise asyncio.TimeoutError()
+        winner = done.pop()
+        if winner is not first:
+            stats['hedges_won'] += 1
+        return winner.result()
+    finally:
+        # Cancel the loser, or both if we were cancelled or ran out of time
+        for task in tasks:
+            task.cancel()
+
+# this is a coroutine definition
+async def web_server_handler_with_deadline(budget=1.0, hedge=True):
+    # Everything started from here on sees this deadline.  If our caller
+    # already has a tighter one, that one still wins -- a budget can only
+    # shrink on the way down, never grow.
+    now = asyncio.get_event_loop().time()
+    outer = deadline.get()
+    token = deadline.set(now + budget if outer is None
+                         else min(outer, now + budget))
+
+    tasks = {
+        'one': asyncio.ensure_future(hedged('one', hedge)),
+        'two': asyncio.ensure_future(hedged('two', hedge)),
+    }
+    try:
+        await asyncio.wait(tasks.values(), timeout=time_left())
+
+        results = {}
+        for name, task in tasks.items():
+            if not task.done():
+                print('deadline reached, cancelling request:   ' + name)
+                stats['deadline_cancellations'] += 1
+                task.cancel()
+            elif task.cancelled():
+                stats['deadline_cancellations'] += 1
+            elif task.exception() is None:
+                results[name] = task.result()
+            elif isinstance(task.exception(), asyncio.TimeoutError):
+                stats['deadline_cancellations'] += 1
+            else:
+                # A real failure, not a deadline -- keep them apart
+                print('request failed:   ' + name, repr(task.exception()))
+                stats['request_failures'] += 1
+        print('partial results:' if len(results) < len(tasks) else 'results:',
+              results)
+        return results
+    finally:
+        # If we were cancelled ourselves, don't leave the requests running
+        for task in tasks.values():
+            task.cancel()
+        # Put the caller's deadline back, in case we were awaited directly
+        # rather than run in a task of our own
+        deadline.reset(token)
+
+async def handle_many_requests(count=20, **kwargs):
+    start = asyncio.get_event_loop().time()
+    await asyncio.gather(*(web_server_handler_with_deadline(**kwargs)
+                           for _ in range(count)))
+    print('{} requests in {:.2f} seconds, {}'.format(
+        count, asyncio.get_event_loop().time() - start, dict(stats)))
+
+loop = asyncio.get_event_loop()
+loop.run_until_complete(handle_many_requests(hedge=False))
+stats.clear()
+loop.run_until_complete(handle_many_requests(hedge=True))
+
+# The handler never takes much longer than its budget, no matter how slow the
+# network is, and every task it started has been cancelled or has finished by
+# the time it returns -- nothing is left running in the background
+
+# Each call to web_server_handler_with_deadline runs in its own task, so it
+# has its own copy of the context, and setting the deadline in one handler
+# does not change it for any other
+
+# Hedging is only safe for requests that can be repeated without harm, like
+# reads -- hedging a request that charges a credit card would charge it twice
@@ -0,0 +1,418 @@
+# An asyncio HTTP load generator
+
+# To see how tutorialedge_restfulapi_aiohttp.py or docker/app.py hold up, we
+# need something that can throw a lot of requests at them from one machine.
+# Tools like wrk or ab aren't always installed, so this one only uses asyncio
+# and the standard library -- one event loop can keep hundreds of requests in
+# flight, since each one spends almost all of its time waiting on the socket.
+
+# KEEP-ALIVE AND POOLING
+    # Opening a TCP connection per request means a handshake per request, and
+    # at high rates the client runs out of ephemeral ports.  HTTP/1.1 lets a
+    # connection carry one request after another, so we keep a pool of open
+    # connections (asyncio.open_connection gives us a reader and a writer)
+    # and hand them out to requests the same way threading/connpool.py hands
+    # out database connections.  A server that answers with
+    # "Connection: close", or with HTTP/1.0 (Flask's development server does)
+    # gets a fresh connection next time.  A server may also close an idle
+    # connection whenever it likes, and we only find out when the next
+    # request on it fails -- so a request that fails that way on a reused
+    # connection is retried once, on a new one.
+
+# CLOSED LOOP vs OPEN LOOP
+    # Closed loop: `concurrency` workers, each sending a request, waiting for
+    # the answer, and sending the next one.  Simple, but when the server
+    # slows down the workers slow down with it and send fewer requests.
+    # Open loop: requests are sent on a fixed schedule (`rate` per second)
+    # whether or not earlier ones have come back, which is how real users
+    # behave -- they don't wait for each other.
+
+# COORDINATED OMISSION
+    # If the server stalls for a second, a closed-loop worker records one slow
+    # request and then carries on -- but the many requests that *would* have
+    # been sent during that second, and would all have been slow, are never
+    # recorded.  The tail latencies end up looking far better than reality.
+    # The fix is to measure every request from when it was *supposed* to be
+    # sent, not from when it actually went out.  Open loop always does this;
+    # closed loop does it too when given a --rate, pacing each worker to
+    # concurrency / rate seconds per request.
+
+# REPORTS
+    # Latencies go into a histogram with logarithmic buckets (about 1%
+    # apart), which is cheap to update and gives percentiles to within that
+    # precision.  Requests that fail or time out are recorded too, at the
+    # time they gave up -- under overload those are the slowest requests of
+    # all, and leaving them out would hide exactly what we're looking for.
+    # They also get a histogram of their own, so they can be told apart.
+    # The report is JSON, so two runs can be compared with
+    # --compare before.json after.json.
+
+import argparse
+import asyncio
+import collections
+import json
+import math
+import sys
+import time
+from urllib.parse import urlsplit
+
+
+class Histogram:
+    """ Latency histogram with logarithmic buckets, in seconds.
+    """
+
+    BASE = 1e-6     # smallest value we care about, one microsecond
+    GROWTH = 1.01   # each bucket is 1% wider than the one before it
+
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def _bucket(self, value):
+        return max(0, int(math.log(max(value, self.BASE) / self.BASE,
+                                    self.GROWTH)))
+
+    def _upper(self, bucket):
+        return self.BASE * self.GROWTH ** (bucket + 1)
+
+    def record(self, value):
+        self.counts[self._bucket(value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def percentile(self, percent):
+        if not self.count:
+            return 0.0
+        wanted = math.ceil(self.count * percent / 100)
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= wanted:
+                return min(self._upper(bucket), self.max)
+        return self.max
+
+    def summary(self):
+        ms = 1000
+        return {
+            "count": self.count,
+            "min": (self.min if self.count else 0.0) * ms,
+            "mean": (self.total / self.count if self.count else 0.0) * ms,
+            "p50": self.percentile(50) * ms,
+            "p90": self.percentile(90) * ms,
+            "p99": self.percentile(99) * ms,
+            "p99.9": self.percentile(99.9) * ms,
+            "max": self.max * ms,
+        }
+
+    def to_json(self):
+        # Upper bound of each bucket, in milliseconds, and its count -- enough
+        # to merge or re-derive percentiles later
+        return {"{:.4f}".format(self._upper(bucket) * 1000): count
+                for bucket, count in sorted(self.counts.items())}
+
+
+class ConnectionPool:
+    """ Keeps up to `size` keep-alive connections to one host open.
+    """
+
+    def __init__(self, host, port, size, ssl=None):
+        self.host = host
+        self.port = port
+        self.ssl = ssl
+        self._slots = asyncio.Semaphore(size)
+        self._idle = []
+        self.opened = 0
+
+    async def acquire(self, fresh=False):
+        # Returns ((reader, writer), reused).  fresh=True skips the idle
+        # connections and always opens a new one.
+        await self._slots.acquire()
+        if self._idle and not fresh:
+            return self._idle.pop(), True
+        try:
+            reader, writer = await asyncio.open_connection(
+                self.host, self.port, ssl=self.ssl)
+        except BaseException:
+            self._slots.release()
+            raise
+        self.opened += 1
+        return (reader, writer), False
+
+    def release(self, connection, reusable):
+        if reusable:
+            self._idle.append(connection)
+        else:
+            connection[1].close()
+        self._slots.release()
+
+    async def close(self):
+        idle, self._idle = self._idle, []
+        for _, writer in idle:
+            writer.close()
+        for _, writer in idle:
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+
+async def _read_response(reader, method):
+    # Returns (status, keep_alive).  The body is read and thrown away.
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("connection closed by server")
+    version, status = status_line.split(None, 2)[:2]
+    status = int(status)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        key, _, value = line.decode("latin-1").partition(":")
+        headers[key.strip().lower()] = value.strip().lower()
+
+    keep_alive = (version == b"HTTP/1.1"
+                  and headers.get("connection") != "close")
+    if method == "HEAD" or status < 200 or status in (204, 304):
+        # These never have a body, whatever the headers say
+        pass
+    elif "content-length" in headers:
+        await reader.readexactly(int(headers["content-length"]))
+    elif (headers.get("transfer-encoding", "").split(",")[-1].strip()
+            == "chunked"):
+        # Other codings (gzip, say) may come first, but chunked is always
+        # applied last
+        while True:
+            size = int((await reader.readline()).split(b";")[0], 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    else:
+        # No length given -- the body runs until the server closes
+        await reader.read()
+        keep_alive = False
+    return status, keep_alive
+
+
+class LoadGenerator:
+    """ Sends one kind of request to a URL and records how long each took.
+    """
+
+    def __init__(self, url, method="GET", body=b"", connections=64,
+                 timeout=10.0):
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https"):
+            raise ValueError("only http:// and https:// URLs are supported, "
+                             "not {!r}".format(url))
+        https = parts.scheme == "https"
+        self.url = url
+        self.method = method = method.upper()
+        self.timeout = timeout
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        self.pool = ConnectionPool(parts.hostname,
+                                   parts.port or (443 if https else 80),
+                                   connections, ssl=True if https else None)
+        self._request = (
+            "{} {} HTTP/1.1\r\n"
+            "Host: {}\r\n"
+            "Connection: keep-alive\r\n"
+            "Content-Length: {}\r\n"
+            "\r\n".format(method, path, parts.netloc, len(body))
+        ).encode("latin-1") + body
+        self.histogram = Histogram()    # every request, failed or not
+        self.failures = Histogram()     # only the ones that failed
+        self.statuses = collections.Counter()
+        self.errors = collections.Counter()
+
+    async def _send(self):
+        connection, reused = await self.pool.acquire()
+        try:
+            return await self._exchange(connection)
+        except ConnectionError:
+            # A reused connection may have been closed by the server while
+            # it sat idle.  That says nothing about the server, so try once
+            # more on a new connection -- a new one that fails is real.
+            if not reused:
+                raise
+        connection, _ = await self.pool.acquire(fresh=True)
+        return await self._exchange(connection)
+
+    async def _exchange(self, connection):
+        reusable = False
+        try:
+            reader, writer = connection
+            writer.write(self._request)
+            await writer.drain()
+            status, reusable = await _read_response(reader, self.method)
+            return status
+        finally:
+            self.pool.release(connection, reusable)
+
+    async def request(self, intended):
+        # Latency is measured from when the request was meant to go out,
+        # including any time spent waiting for a free connection
+        try:
+            status = await asyncio.wait_for(self._send(), self.timeout)
+        except Exception as e:
+            elapsed = time.perf_counter() - intended
+            self.histogram.record(elapsed)
+            self.failures.record(elapsed)
+            self.errors[type(e).__name__] += 1
+            return
+        self.histogram.record(time.perf_counter() - intended)
+        self.statuses[status] += 1
+
+    async def open_loop(self, rate, duration):
+        start = time.perf_counter()
+        tasks = set()
+        index = 0
+        while True:
+            intended = start + index / rate
+            if intended - start >= duration:
+                break
+            delay = intended - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            task = asyncio.ensure_future(self.request(intended))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            index += 1
+        if tasks:
+            await asyncio.wait(tasks)
+
+    async def closed_loop(self, concurrency, duration, rate=None):
+        start = time.perf_counter()
+        interval = concurrency / rate if rate else 0.0
+
+        async def worker(offset):
+            intended = start + offset
+            while intended - start < duration:
+                delay = intended - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                if not interval:
+                    # Unpaced -- measure from the actual send, and accept
+                    # that the results are subject to coordinated omission
+                    intended = time.perf_counter()
+                await self.request(intended)
+                intended = (intended + interval if interval
+                            else time.perf_counter())
+
+        await asyncio.gather(*(worker(index * interval / concurrency)
+                               for index in range(concurrency)))
+
+    def report(self, mode, elapsed, **settings):
+        report = {
+            "url": self.url,
+            "method": self.method,
+            "mode": mode,
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "elapsed": elapsed,
+            "requests": self.histogram.count,
+            "failed": self.failures.count,
+            # Successful responses per second
+            "throughput": (self.histogram.count - self.failures.count)
+                          / elapsed,
+            "connections_opened": self.pool.opened,
+            "statuses": {str(k): v for k, v in self.statuses.items()},
+            "errors": dict(self.errors),
+            "latency_ms": self.histogram.summary(),
+            "histogram_ms": self.histogram.to_json(),
+            "failed_latency_ms": self.failures.summary(),
+        }
+        report.update(settings)
+        return report
+
+
+async def run(generator, args):
+    start = time.perf_counter()
+    if args.mode == "open":
+        await generator.open_loop(args.rate, args.duration)
+    else:
+        await generator.closed_loop(args.concurrency, args.duration, args.rate)
+    elapsed = time.perf_counter() - start
+    await generator.pool.close()
+    return generator.report(args.mode, elapsed, rate=args.rate,
+                            concurrency=args.concurrency,
+                            connections=args.connections)
+
+
+def compare(before, after):
+    """ Prints how the headline numbers moved between two reports.
+    """
+    rows = [("throughput", before["throughput"], after["throughput"])]
+    for key in ("p50", "p90", "p99", "p99.9", "max"):
+        rows.append((key + " ms", before["latency_ms"][key],
+                     after["latency_ms"][key]))
+    rows.append(("errors", sum(before["errors"].values()),
+                 sum(after["errors"].values())))
+    for name, old, new in rows:
+        change = (new - old) / old * 100 if old else 0.0
+        print("{:12} {:12.3f} {:12.3f} {:+8.1f}%".format(name, old, new,
+                                                          change))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="asyncio HTTP load generator")
+    parser.add_argument("url", nargs="?", default="http://localhost:8080/")
+    parser.add_argument("--method", default="GET")
+    parser.add_argument("--data", default="", help="request body")
+    parser.add_argument("--mode", choices=("open", "closed"), default="open")
+    parser.add_argument("--rate", type=float,
+                        help="requests per second (required for open loop)")
+    parser.add_argument("--concurrency", type=int, default=10,
+                        help="workers in closed loop")
+    parser.add_argument("--connections", type=int, default=64,
+                        help="most keep-alive connections open at once")
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--timeout", type=float, default=10.0)
+    parser.add_argument("--output", help="write the JSON report here")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"),
+                        help="compare two saved reports and exit")
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as f, open(args.compare[1]) as g:
+            compare(json.load(f), json.load(g))
+        sys.exit()
+    if args.mode == "open" and not args.rate:
+        parser.error("--mode open needs a --rate")
+
+    loop = asyncio.get_event_loop()
+    try:
+        try:
+            generator = LoadGenerator(args.url, args.method,
+                                      args.data.encode(), args.connections,
+                                      args.timeout)
+        except ValueError as e:
+            parser.error(str(e))
+        report = loop.run_until_complete(run(generator, args))
+    finally:
+        loop.close()
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    print(text)
+
+# Against the aiohttp example (it listens on port 8080):
+#     python loadgen.py http://localhost:8080/ --rate 500 --duration 10
+#     python loadgen.py "http://localhost:8080/user?name=bob" --method POST \
+#         --mode closed --concurrency 20
+
+# Against the Flask app from docker/ (docker-compose maps it to port 80):
+#     python loadgen.py http://localhost/ --rate 100 --output flask.json
+
+# In open loop, if the server can't keep up, requests queue for a connection
+# and the latencies grow without bound -- that is the correct result, it means
+# the rate is above what the server can sustain
+
+# --connections caps how many requests are in flight at once, in both modes
@@ -0,0 +1,350 @@
+# A bounded connection pool using a Semaphore
+
+# The notes at the bottom of prodcom_queue.py describe using a
+# threading.Semaphore to protect "a pool of connections" -- this is that pool.
+
+# racecond.py's FakeDatabase is one object that every thread shares.  A real
+# database client is usually the opposite: each thread needs a connection of
+# its own while it works, and opening a connection (TCP handshake, TLS,
+# authentication) is expensive.  Opening one per task wastes most of the time
+# on setup, and opening as many as there are tasks can overwhelm the server.
+
+# A pool keeps a handful of connections open and lends them out:
+
+    # The Semaphore starts at max_size.  Every .acquire() on the pool takes
+    # one count, so no more than max_size connections are ever lent out, and
+    # the (max_size + 1)th caller waits.  Waiting has a timeout -- when the
+    # pool is saturated it is usually better to fail fast and let the caller
+    # shed load than to queue up forever.
+
+    # Idle connections sit in a list.  Connections are created lazily, only
+    # when a caller arrives and the list is empty, and up to min_size of them
+    # are created up front so the first callers don't pay for it.
+
+    # Before a connection is lent out, an optional health check runs on it.
+    # One that fails is closed and replaced.
+
+    # Connections that have sat idle longer than idle_timeout are closed,
+    # down to min_size, so a burst doesn't leave lots of connections open.
+    # This is checked whenever a connection is borrowed or returned, and by
+    # a small reaper thread, so a pool that goes quiet still shrinks.
+
+import concurrent.futures
+import contextlib
+import itertools
+import logging
+import threading
+import time
+import weakref
+
+
+class PoolExhausted(Exception):
+    """ Raised when no connection frees up before the acquire timeout.
+    """
+
+
+class ResourcePool:
+    """ Lends out up to max_size resources created by factory().
+    """
+
+    def __init__(self, factory, min_size=0, max_size=5, timeout=1.0,
+                 idle_timeout=30.0, health_check=None, close=None):
+        if idle_timeout is None or idle_timeout <= 0:
+            raise ValueError("idle_timeout must be greater than 0")
+        self.factory = factory
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.health_check = health_check
+        self._close = close
+        self._slots = threading.Semaphore(max_size)
+        self._lock = threading.Lock()
+        self._idle = []     # (resource, time it was returned), newest last
+        self._lent = {}     # id(resource) -> time it was lent out
+        self._size = 0      # resources open, lent out or idle
+
+        # Metrics
+        self.created = 0
+        self.closed = 0
+        self.acquired = 0
+        self.exhausted = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.busy_time = 0.0
+        self._started = time.monotonic()
+
+        for _ in range(min_size):
+            self._idle.append((self._create(), time.monotonic()))
+
+        # The reaper only holds a weak reference to the pool, so a pool that
+        # nobody closed can still be garbage collected (the reaper then exits)
+        self._closing = threading.Event()
+        self._reaper = threading.Thread(
+            target=ResourcePool._reap, daemon=True, name="ResourcePool-reaper",
+            args=(weakref.ref(self), self._closing,
+                  max(0.01, min(idle_timeout / 2, 1.0))))
+        self._reaper.start()
+
+    def _create(self):
+        resource = self.factory()
+        with self._lock:
+            self._size += 1
+            self.created += 1
+        return resource
+
+    def _discard(self, resource):
+        with self._lock:
+            self._size -= 1
+            self.closed += 1
+        if self._close is not None:
+            self._close(resource)
+
+    def _evict_idle(self, now):
+        # The oldest idle resources are at the front of the list
+        expired = []
+        with self._lock:
+            while (self._idle and self._size - len(expired) > self.min_size
+                    and now - self._idle[0][1] > self.idle_timeout):
+                expired.append(self._idle.pop(0)[0])
+        for resource in expired:
+            logging.debug("Pool: evicting idle resource %s", resource)
+            self._discard(resource)
+
+    @staticmethod
+    def _reap(pool_ref, closing, interval):
+        while not closing.wait(interval):
+            pool = pool_ref()
+            if pool is None:
+                return
+            pool._evict_idle(time.monotonic())
+            del pool
+
+    def _fill(self):
+        # Top the pool back up to min_size, after health checks have thrown
+        # some resources away.  Count each one before creating it, so that
+        # two threads doing this at once don't overshoot.
+        while True:
+            with self._lock:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
+            try:
+                resource = self.factory()
+            except BaseException:
+                with self._lock:
+                    self._size -= 1
+                raise
+            with self._lock:
+                self.created += 1
+                self._idle.append((resource, time.monotonic()))
+
+    def _healthy(self, resource):
+        if self.health_check is None:
+            return True
+        # A check that blows up is as good as a check that failed
+        try:
+            return self.health_check(resource)
+        except Exception:
+            logging.debug("Pool: health check on %s raised", resource,
+                          exc_info=True)
+            return False
+
+    def acquire(self, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        start = time.monotonic()
+        self._evict_idle(start)
+        if not self._slots.acquire(timeout=timeout):
+            with self._lock:
+                self.exhausted += 1
+            raise PoolExhausted(
+                "no resource free after {:.3f}s".format(timeout))
+        waited = time.monotonic() - start
+        with self._lock:
+            self.acquired += 1
+            self.wait_time += waited
+            self.max_wait = max(self.max_wait, waited)
+
+        try:
+            while True:
+                with self._lock:
+                    # Hand out the most recently used resource, so the
+                    # oldest ones are the ones left to go idle
+                    resource = self._idle.pop()[0] if self._idle else None
+                if resource is None:
+                    resource = self._create()
+                    break
+                if self._healthy(resource):
+                    break
+                logging.debug("Pool: resource %s failed health check",
+                              resource)
+                self._discard(resource)
+                self._fill()
+        except BaseException:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._lent[id(resource)] = time.monotonic()
+        return resource
+
+    def release(self, resource):
+        now = time.monotonic()
+        with self._lock:
+            try:
+                lent_at = self._lent.pop(id(resource))
+            except KeyError:
+                raise ValueError(
+                    "{!r} was not lent out by this pool".format(resource))
+            self.busy_time += now - lent_at
+            self._idle.append((resource, now))
+        self._slots.release()
+        self._evict_idle(now)
+
+    @contextlib.contextmanager
+    def connection(self, timeout=None):
+        resource = self.acquire(timeout)
+        try:
+            yield resource
+        finally:
+            self.release(resource)
+
+    def stats(self):
+        with self._lock:
+            elapsed = time.monotonic() - self._started
+            return {
+                "size": self._size,
+                "idle": len(self._idle),
+                "created": self.created,
+                "closed": self.closed,
+                "acquired": self.acquired,
+                "exhausted": self.exhausted,
+                "avg_wait": self.wait_time / self.acquired
+                            if self.acquired else 0.0,
+                "max_wait": self.max_wait,
+                # Fraction of the pool's capacity that was lent out
+                "utilization": self.busy_time / (elapsed * self.max_size),
+            }
+
+    def close(self):
+        self._closing.set()
+        self._reaper.join()
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for resource, _ in idle:
+            self._discard(resource)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# The rest of this file puts a FakeDatabase-style client on top of the pool
+
+class FakeConnection:
+    """ A connection that takes a while to open.
+    """
+
+    # count += 1 isn't atomic, but next() on an itertools.count is
+    _ids = itertools.count(1)
+
+    def __init__(self, connect_time=0.05):
+        time.sleep(connect_time)
+        self.id = next(FakeConnection._ids)
+        self.open = True
+
+    def execute(self, name):
+        time.sleep(0.01)
+        logging.debug("Thread %s: ran query on connection %d", name, self.id)
+
+    def ping(self):
+        return self.open
+
+    def close(self):
+        self.open = False
+
+    def __repr__(self):
+        return "FakeConnection({})".format(self.id)
+
+
+class FakeDatabase:
+    def __init__(self, pool):
+        self.pool = pool
+
+    def update(self, name):
+        logging.info("Thread %s: starting update", name)
+        try:
+            with self.pool.connection() as conn:
+                conn.execute(name)
+        except PoolExhausted:
+            logging.info("Thread %s: pool exhausted, rejecting update", name)
+            return False
+        logging.info("Thread %s: finishing update", name)
+        return True
+
+
+def _unpooled_update(name):
+    conn = FakeConnection()
+    try:
+        conn.execute(name)
+    finally:
+        conn.close()
+
+
+def benchmark(tasks=200, workers=10):
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        list(executor.map(_unpooled_update, range(tasks)))
+    unpooled = time.perf_counter() - start
+
+    with ResourcePool(FakeConnection, min_size=2, max_size=workers,
+                      health_check=FakeConnection.ping,
+                      close=FakeConnection.close) as pool:
+        database = FakeDatabase(pool)
+        start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            list(executor.map(database.update, range(tasks)))
+        pooled = time.perf_counter() - start
+        stats = pool.stats()
+
+    logging.warning("connection per task: %.2fs, %d connections opened",
+                    unpooled, tasks)
+    logging.warning("pooled             : %.2fs, %d connections opened",
+                    pooled, stats["created"])
+    logging.warning("pool stats: %s", stats)
+
+
+if __name__ == "__main__":
+    format = "%(asctime)s: %(message)s"
+    logging.basicConfig(format=format, level=logging.INFO,
+                        datefmt="%H:%M:%S")
+
+    # Two connections, four threads and a short timeout -- some updates
+    # get rejected instead of waiting
+    with ResourcePool(FakeConnection, max_size=2, timeout=0.015,
+                      health_check=FakeConnection.ping,
+                      close=FakeConnection.close) as pool:
+        database = FakeDatabase(pool)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            for index in range(8):
+                executor.submit(database.update, index)
+        logging.info("Pool stats: %s", pool.stats())
+
+    logging.getLogger().setLevel(logging.WARNING)
+    benchmark()
+
+# Each thread still gets a connection of its own, so there is no race on the
+# connection itself -- the Lock inside the pool only protects the pool's own
+# bookkeeping, and is never held while a connection is being opened, checked
+# or used
+
+# Semaphore.acquire(timeout=...) returns False instead of raising when it
+# times out, which is why .acquire() above checks the return value
+
+# Setting timeout=0 turns the pool into pure admission control: callers
+# either get a connection immediately or are rejected immediately
+
+# The pool can be used in a with statement, which closes it (and every idle
+# connection) on the way out.  A pool that is never closed still gets garbage
+# collected, but its idle connections are only dropped, not closed
@@ -0,0 +1,329 @@
+# An auto-scaling thread pool
+
+# executor.py, racecond.py and the producer/consumer examples all use
+# ThreadPoolExecutor(max_workers=2) or (max_workers=3).  A fixed size is
+# always wrong for somebody: too small and a burst of work sits in the queue
+# waiting for a free thread, too large and dozens of idle threads (each with
+# its own stack) hang around between bursts.  ThreadPoolExecutor also never
+# gets rid of a thread once it has started one.
+
+# An elastic pool sizes itself between min_workers and max_workers:
+
+    # GROW -- a background monitor looks at the oldest task still in the
+    # queue.  If it has been waiting longer than target_wait and no worker is
+    # idle, the pool adds a worker, and keeps adding one per check until the
+    # queue catches up.  Short blips that clear up on their own within
+    # target_wait never start a thread.
+
+    # SHRINK -- a worker that has had nothing to do for keep_alive seconds
+    # exits, unless that would take the pool below min_workers.
+
+# It is a concurrent.futures.Executor, so .submit(), .map() and the with
+# statement work exactly as they do on ThreadPoolExecutor -- .map() comes for
+# free from the base class, which builds it on top of .submit().  Like
+# ThreadPoolExecutor, its threads aren't daemon threads, and a pool that is
+# still running when the interpreter exits is shut down first, so work that
+# was already submitted still gets done.
+
+import concurrent.futures
+import logging
+import queue
+import threading
+import time
+import weakref
+
+# Every pool that hasn't been shut down, so they can all be shut down at exit
+_executors = weakref.WeakSet()
+
+
+def _python_exit():
+    for executor in list(_executors):
+        executor.shutdown(wait=True)
+
+
+# Like atexit, but runs before the interpreter waits for non-daemon threads
+# -- which ours would never finish without their sentinels.  This is what
+# concurrent.futures.thread does too.
+threading._register_atexit(_python_exit)
+
+
+class _WorkItem:
+    def __init__(self, future, fn, args, kwargs):
+        self.future = future
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.enqueued = time.monotonic()
+
+    def run(self):
+        if not self.future.set_running_or_notify_cancel():
+            return
+        try:
+            result = self.fn(*self.args, **self.kwargs)
+        except BaseException as e:
+            self.future.set_exception(e)
+        else:
+            self.future.set_result(result)
+
+
+class ElasticThreadPoolExecutor(concurrent.futures.Executor):
+    """ Thread pool that grows while tasks wait and shrinks while idle.
+    """
+
+    def __init__(self, min_workers=1, max_workers=32, target_wait=0.01,
+                 keep_alive=1.0, thread_name_prefix="Elastic"):
+        if not 0 <= min_workers <= max_workers or max_workers < 1:
+            raise ValueError("need 0 <= min_workers <= max_workers, "
+                             "and max_workers >= 1")
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.target_wait = target_wait
+        self.keep_alive = keep_alive
+        self._prefix = thread_name_prefix
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._workers = set()
+        self._idle = 0
+        self._shutdown = False
+        self._stop = threading.Event()
+        self._pending = threading.Event()   # set when something is queued
+
+        # Metrics
+        self.peak_size = 0
+        self.started = 0
+        self.retired = 0
+        self.tasks = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+        with self._lock:
+            for _ in range(min_workers):
+                self._start_worker()
+        self._monitor = threading.Thread(target=self._watch,
+                                         name=self._prefix + "-monitor")
+        self._monitor.start()
+        _executors.add(self)
+
+    @property
+    def pool_size(self):
+        return len(self._workers)
+
+    def _start_worker(self):
+        # Called with self._lock held
+        self.started += 1
+        worker = threading.Thread(
+            target=self._work,
+            name="{}-{}".format(self._prefix, self.started))
+        self._workers.add(worker)
+        self.peak_size = max(self.peak_size, len(self._workers))
+        worker.start()
+
+    def _oldest_wait(self):
+        # Queue keeps its items in a deque, guarded by its own mutex.  Skip
+        # anything that isn't a task, like the None sentinels from shutdown.
+        with self._queue.mutex:
+            for item in self._queue.queue:
+                if isinstance(item, _WorkItem):
+                    return time.monotonic() - item.enqueued
+        return 0.0
+
+    def _watch(self):
+        while True:
+            # Nothing can be waiting while the queue is empty, so park until
+            # submit() queues something instead of waking up every
+            # target_wait / 2 for nothing
+            self._pending.wait()
+            if self._stop.wait(self.target_wait / 2):
+                return
+            self._maybe_grow()
+            # Clear first and then look, so a submit() in between isn't lost
+            self._pending.clear()
+            if not self._queue.empty():
+                self._pending.set()
+
+    def _maybe_grow(self):
+        if self._shutdown:
+            return
+        waited = self._oldest_wait()
+        with self._lock:
+            if self._shutdown:
+                return
+            if not self._workers:
+                # Every worker timed out (min_workers=0) and work arrived
+                if waited or not self._queue.empty():
+                    self._start_worker()
+            elif (waited > self.target_wait and self._idle == 0
+                    and len(self._workers) < self.max_workers):
+                logging.debug("Pool: oldest task waited %.3fs, growing to %d",
+                              waited, len(self._workers) + 1)
+                self._start_worker()
+
+    def _work(self):
+        me = threading.current_thread()
+        while True:
+            with self._lock:
+                self._idle += 1
+            try:
+                item = self._queue.get(timeout=self.keep_alive)
+            except queue.Empty:
+                item = False
+            with self._lock:
+                self._idle -= 1
+                if item is False:
+                    # submit() queues work under this lock, so if the queue
+                    # is empty now, anything submitted after this will see
+                    # the worker gone and start a new one
+                    if (len(self._workers) > self.min_workers
+                            and self._queue.empty()):
+                        logging.debug("Pool: idle worker exiting")
+                        self._workers.discard(me)
+                        self.retired += 1
+                        return
+                    continue
+                if item is None:
+                    self._workers.discard(me)
+                    return
+                waited = time.monotonic() - item.enqueued
+                self.tasks += 1
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+            item.run()
+            del item
+
+    def submit(self, fn, /, *args, **kwargs):
+        future = concurrent.futures.Future()
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError(
+                    "cannot schedule new futures after shutdown")
+            self._queue.put(_WorkItem(future, fn, args, kwargs))
+            self._pending.set()
+            # Never leave work queued with no one to run it
+            if not self._workers:
+                self._start_worker()
+        return future
+
+    def stats(self):
+        with self._lock:
+            return {
+                "pool_size": len(self._workers),
+                "idle": self._idle,
+                "queued": self._queue.qsize(),
+                "peak_size": self.peak_size,
+                "started": self.started,
+                "retired": self.retired,
+                "tasks": self.tasks,
+                "avg_queue_wait": self.wait_total / self.tasks
+                                  if self.tasks else 0.0,
+                "max_queue_wait": self.wait_max,
+            }
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        with self._lock:
+            self._shutdown = True
+            workers = list(self._workers)
+        # Stop the monitor before queueing the sentinels, so that it never
+        # sees them or starts a worker that would miss its sentinel
+        self._stop.set()
+        self._pending.set()
+        self._monitor.join()
+        if cancel_futures:
+            while True:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                # Skip sentinels left by an earlier shutdown(wait=False)
+                if item is not None:
+                    item.future.cancel()
+        # One None per worker, queued behind the remaining work
+        for _ in workers:
+            self._queue.put(None)
+        if wait:
+            for worker in workers:
+                worker.join()
+        _executors.discard(self)
+
+
+# BENCHMARK
+# Bursts of I/O-bound tasks (a short sleep each) with quiet gaps in between,
+# run on two fixed pools and on the elastic pool.  For each we report how long
+# tasks took from submit to done, and how many threads the pool was holding
+# on average, sampled every few milliseconds.
+
+def _io_task(duration):
+    time.sleep(duration)
+
+
+def _run_bursts(executor, bursts, size, gap, duration):
+    latencies = []
+    samples = []
+    sampling = threading.Event()
+
+    def sample():
+        while not sampling.wait(0.005):
+            samples.append(threading.active_count())
+
+    sampler = threading.Thread(target=sample)
+    sampler.start()
+    for _ in range(bursts):
+        start = time.monotonic()
+        futures = [executor.submit(_io_task, duration) for _ in range(size)]
+        for future in futures:
+            future.add_done_callback(
+                lambda f, s=start: latencies.append(time.monotonic() - s))
+        concurrent.futures.wait(futures)
+        time.sleep(gap)
+    sampling.set()
+    sampler.join()
+    executor.shutdown()
+    latencies.sort()
+    # Don't count the main thread and the sampler
+    return (latencies[len(latencies) // 2],
+            latencies[int(len(latencies) * 0.99)],
+            sum(samples) / len(samples) - 2)
+
+
+def benchmark(bursts=5, size=100, gap=1.5, duration=0.02):
+    # Build each pool only when its turn comes, so that the elastic pool's
+    # threads aren't counted against the fixed pools
+    pools = (
+        ("fixed(3)",
+         lambda: concurrent.futures.ThreadPoolExecutor(max_workers=3)),
+        ("fixed(32)",
+         lambda: concurrent.futures.ThreadPoolExecutor(max_workers=32)),
+        ("elastic(1-32)",
+         lambda: ElasticThreadPoolExecutor(1, 32, keep_alive=0.5)),
+    )
+    for label, make_pool in pools:
+        p50, p99, threads = _run_bursts(make_pool(), bursts, size, gap,
+                                        duration)
+        logging.info("%-13s: latency p50=%.3fs p99=%.3fs, %.1f threads on "
+                     "average", label, p50, p99, threads)
+
+
+if __name__ == "__main__":
+    format = "%(asctime)s: %(message)s"
+    logging.basicConfig(format=format, level=logging.INFO,
+                        datefmt="%H:%M:%S")
+
+    def thread_function(name):
+        logging.info("Thread %s: starting", name)
+        time.sleep(0.2)
+        logging.info("Thread %s: finishing", name)
+
+    with ElasticThreadPoolExecutor(max_workers=8,
+                                   target_wait=0.05) as executor:
+        executor.map(thread_function, range(12))
+        time.sleep(0.5)
+        logging.info("Main    : pool %s", executor.stats())
+    logging.info("Main    : pool %s", executor.stats())
+
+    benchmark()
+
+# The pool only grows one worker per check, every target_wait / 2 seconds, so
+# going from 1 to 32 workers takes 16 * target_wait -- a smaller target_wait
+# reacts faster but starts threads for bursts that would have cleared anyway
+
+# The average thread counts above subtract the main and sampler threads; the
+# elastic pool's count includes its monitor thread
@@ -0,0 +1,323 @@
+# Producer-Consumer with adaptive rate control
+
+# In prodcom_queue.py the producer generates messages as fast as it can, and
+# the only thing holding it back is the maxsize=10 on the Queue blocking
+# .put().  That means the queue sits full most of the time, every message
+# waits behind nine others, and how long it waits swings with whatever the
+# consumer happens to be doing.
+
+# Instead, the producer can pace itself.  Two pieces work together:
+
+    # A TOKEN BUCKET holds up to `burst` tokens and refills at `rate` tokens
+    # per second.  The producer takes one token per message, and if the
+    # bucket is empty it sleeps until the next token is due -- so it never
+    # spins, and it never sends faster than `rate` for long.
+
+    # An AIMD CONTROLLER (additive increase, multiplicative decrease -- the
+    # same idea TCP uses for its congestion window) adjusts `rate`.  Every so
+    # often it looks at how deep the queue is and how fast the consumer has
+    # been draining it.  By Little's law, depth / drain rate is roughly how
+    # long a new message will sit in the queue.  If that is under the latency
+    # target, the rate creeps up by a constant; if it is over, the rate is cut
+    # by a fraction.  Creeping up slowly and backing off quickly keeps the
+    # queue short without starving the consumer.
+
+import concurrent.futures
+import logging
+import queue
+import random
+import statistics
+import threading
+import time
+
+from prodcom_queue import Pipeline
+
+
+class TokenBucket:
+    """ Hands out tokens at a steady rate, with room for a small burst.
+    """
+
+    def __init__(self, rate, min_sleep=0.002, burst_time=0.01):
+        self.rate = rate
+        # Waking up costs CPU, so never sleep for less than min_sleep, and
+        # let the tokens that pile up meanwhile be spent back to back.  The
+        # OS often oversleeps, so keep up to burst_time worth of tokens, or
+        # the ones that arrive during an oversleep are lost.
+        self.min_sleep = min_sleep
+        self.burst_time = burst_time
+        self._tokens = 1.0
+        self._last = time.monotonic()
+
+    def _refill(self, now):
+        burst = max(1.0, self.rate * self.burst_time)
+        self._tokens = min(burst,
+                           self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def acquire(self, event):
+        # Sleep rather than spin while waiting for a token, but wake up in
+        # time to notice the exit event
+        while not event.is_set():
+            self._refill(time.monotonic())
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            event.wait(max(self.min_sleep, (1 - self._tokens) / self.rate))
+        return False
+
+
+class AIMDController:
+    """ Adjusts a TokenBucket's rate to keep queueing delay under a target.
+    """
+
+    def __init__(self, bucket, pipeline, target_latency=0.005, interval=0.05,
+                 increase=50.0, decrease=0.8, min_rate=10.0, max_rate=100000.0,
+                 drain_floor=0.95, drain_ceiling=1.05):
+        self.bucket = bucket
+        self.pipeline = pipeline
+        self.target_latency = target_latency
+        self.interval = interval
+        self.increase = increase
+        self.decrease = decrease
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.drain_floor = drain_floor
+        self.drain_ceiling = drain_ceiling
+        self.increases = 0
+        self.decreases = 0
+        self._slow_start = True
+        self._last = time.monotonic()
+        self._drained = pipeline.drained
+
+    def maybe_adjust(self):
+        now = time.monotonic()
+        elapsed = now - self._last
+        if elapsed < self.interval:
+            return
+        drained = self.pipeline.drained
+        drain_rate = (drained - self._drained) / elapsed
+        self._last, self._drained = now, drained
+
+        depth = self.pipeline.qsize()
+        # With nothing drained yet there is no estimate, so only back off if
+        # messages are actually piling up
+        if drain_rate > 0:
+            expected_latency = depth / drain_rate
+        else:
+            expected_latency = float("inf") if depth else 0.0
+
+        if expected_latency > self.target_latency:
+            # Multiplicative decrease -- but never much below what the
+            # consumer has just shown it can drain, or it sits idle while
+            # the rate climbs back up
+            rate = self.bucket.rate * self.decrease
+            if drain_rate > 0:
+                rate = max(rate, drain_rate * self.drain_floor)
+            rate = max(self.min_rate, min(rate, self.bucket.rate))
+            self.decreases += 1
+            self._slow_start = False
+        elif expected_latency > self.target_latency / 2:
+            # A small backlog keeps the consumer busy without making anyone
+            # wait long -- leave the rate alone
+            rate = self.bucket.rate
+        elif self._slow_start and not depth:
+            # Like TCP, double the rate until the first sign of congestion
+            # (here, the consumer having a backlog at all), rather than
+            # creeping up from the starting rate
+            rate = min(self.max_rate, self.bucket.rate * 2)
+            self.increases += 1
+        else:
+            self._slow_start = False
+            rate = min(self.max_rate, self.bucket.rate + self.increase)
+            if depth:
+                # The consumer is busy, so it is the bottleneck -- sending
+                # much faster than it drains would only grow the queue
+                rate = min(rate, max(self.min_rate,
+                                     drain_rate * self.drain_ceiling))
+            self.increases += 1
+        logging.debug("AIMD: depth=%d drain=%.0f/s latency=%.4fs rate=%.0f/s",
+                      depth, drain_rate, expected_latency, rate)
+        self.bucket.rate = rate
+
+
+class TimedPipeline(Pipeline):
+    """ Pipeline that records how long each message spent in the queue.
+    """
+
+    def __init__(self, maxsize=10):
+        super().__init__()
+        # Queue looks at self.maxsize on every .put(), so it can be changed
+        # after Pipeline has set it to 10.  0 means unbounded.
+        self.maxsize = maxsize
+        self.drained = 0
+        self.latencies = []
+
+    def set_message(self, value, name):
+        logging.debug("%s:about to add %d to queue", name, value)
+        self.put((time.monotonic(), value))
+        logging.debug("%s:added %d to queue", name, value)
+
+    def get_message(self, name, timeout=None):
+        logging.debug("%s:about to get from queue", name)
+        stamp, value = self.get(timeout=timeout)
+        self.latencies.append(time.monotonic() - stamp)
+        self.drained += 1
+        logging.debug("%s:got %d from queue", name, value)
+        return value
+
+
+def adaptive_producer(pipeline, event, bucket, controller):
+    """ Retrieves numbers from the network, no faster than the consumer can
+    save them.
+    """
+    while bucket.acquire(event):
+        controller.maybe_adjust()
+        message = random.randint(1, 101)
+        logging.info("Producer got message: %s", message)
+        pipeline.set_message(message, "Producer")
+
+    logging.info("Producer received EXIT event. Exiting")
+
+
+def consumer(pipeline, event):
+    """ Saves a number in the database.
+    """
+    while not event.is_set() or not pipeline.empty():
+        # A paced producer may be asleep waiting for a token when the event
+        # is set, and will never send the message a blocking .get() is
+        # waiting for -- so time out and check the event again
+        try:
+            message = pipeline.get_message("Consumer", timeout=0.1)
+        except queue.Empty:
+            continue
+        logging.info(
+            "Consumer storing message: %s (queue size=%s)",
+            message,
+            pipeline.qsize(),
+        )
+
+    logging.info("Consumer received EXIT event. Exiting")
+
+
+# BENCHMARK
+# The consumer below stands in for a database write that takes about a
+# millisecond, fed through a queue big enough that it never fills up in the
+# time the benchmark runs.  That is the case this file is about: with nothing
+# pushing back, a spinning producer races ahead of the consumer and the queue
+# only ever grows.  Both runs use the same consumer and the same queue; the
+# only difference is whether the producer spins or is paced.
+# For each run we report messages saved per second, how long they sat in the
+# queue, what share of them waited longer than target_latency, the producer's
+# CPU time (measured per thread with time.thread_time()) and how many
+# messages were still queued, unsaved, when the run ended.
+
+def _save(pipeline, event, cost):
+    # Stop when the run ends, rather than draining whatever is left, so that
+    # the backlog shows up in the report instead of in the run time
+    while not event.is_set():
+        try:
+            pipeline.get_message("Consumer", timeout=0.1)
+        except queue.Empty:
+            continue
+        time.sleep(cost)
+
+
+def _spin(pipeline, event, cpu, controllers, target_latency):
+    start = time.thread_time()
+    while not event.is_set():
+        pipeline.set_message(random.randint(1, 101), "Producer")
+    cpu.append(time.thread_time() - start)
+
+
+def _paced(pipeline, event, cpu, controllers, target_latency):
+    bucket = TokenBucket(rate=100.0)
+    controller = AIMDController(bucket, pipeline, target_latency)
+    controllers.append(controller)
+    start = time.thread_time()
+    while bucket.acquire(event):
+        controller.maybe_adjust()
+        pipeline.set_message(random.randint(1, 101), "Producer")
+    cpu.append(time.thread_time() - start)
+
+
+def _report(label, pipeline, cpu, controllers, duration, target_latency):
+    latencies = sorted(pipeline.latencies)
+    p50 = latencies[len(latencies) // 2]
+    p99 = latencies[int(len(latencies) * 0.99)]
+    late = sum(1 for latency in latencies if latency > target_latency)
+    logging.info(
+        "%-8s: %6.0f msgs/s  latency p50=%.2fms p99=%.2fms stdev=%.2fms  "
+        "%.1f%% over target  producer cpu=%.2fs  backlog=%d",
+        label, len(latencies) / duration, p50 * 1000, p99 * 1000,
+        statistics.pstdev(latencies) * 1000, 100.0 * late / len(latencies),
+        cpu[0], pipeline.qsize())
+    for controller in controllers:
+        logging.info("%-8s: controller made %d increases, %d decreases, "
+                     "finished at %.0f msgs/s", label, controller.increases,
+                     controller.decreases, controller.bucket.rate)
+
+
+def benchmark(duration=3.0, cost=0.001, target_latency=0.005,
+              maxsize=1_000_000):
+    # maxsize is only there so a runaway producer can't eat all the memory
+    for label, produce in (("spinning", _spin), ("adaptive", _paced)):
+        pipeline = TimedPipeline(maxsize)
+        event = threading.Event()
+        cpu = []
+        controllers = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            executor.submit(produce, pipeline, event, cpu, controllers,
+                            target_latency)
+            executor.submit(_save, pipeline, event, cost)
+            time.sleep(duration)
+            event.set()
+        _report(label, pipeline, cpu, controllers, duration, target_latency)
+
+
+if __name__ == "__main__":
+    format = "%(asctime)s: %(message)s"
+    logging.basicConfig(format=format, level=logging.INFO,
+                        datefmt="%H:%M:%S")
+
+    pipeline = TimedPipeline()
+    event = threading.Event()
+    bucket = TokenBucket(rate=100.0)
+    controller = AIMDController(bucket, pipeline)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        executor.submit(adaptive_producer, pipeline, event, bucket, controller)
+        executor.submit(consumer, pipeline, event)
+
+        time.sleep(0.1)
+        logging.info("Main: about to set event")
+        event.set()
+
+    benchmark()
+
+# The Queue is the same one from prodcom_queue.py.  The demo above keeps its
+# maxsize=10 as a backstop in case the controller lets a burst through; the
+# benchmark lifts it to show what happens without one
+
+# WHAT THE BENCHMARK SHOWS -- and what it doesn't
+    # (Measured on one CPU; your numbers will differ, the shape shouldn't)
+    # The spinning producer builds a backlog of 600,000-700,000 messages in
+    # three seconds.  Every saved message waited longer than the 5ms target
+    # (p50 about 1.5s, p99 about 3s), and because the spinning thread hogs
+    # the GIL, the consumer only managed about 160 saves per second and the
+    # producer burned 2.9s of CPU in a 3s run.
+    # The paced producer saves about 770-810 messages per second with
+    # almost no backlog and about 0.1s of producer CPU.  The median message
+    # waits 4-5ms -- but that is right at the target, and about half of them
+    # wait longer than it, with a p99 of 70-95ms.  The controller
+    # keeps the queue *short*, not every message under target_latency: it
+    # only looks every 50ms, and the rate saws up and down around the
+    # consumer's real capacity (20-30 increases and decreases per run).
+    # Against a small bounded queue (maxsize=10, as in prodcom_queue.py) the
+    # comparison looks different: the spinning producer spends most of its
+    # time blocked in .put(), which costs no CPU, so there the paced
+    # producer came out 7-12% slower, with a less steady latency and more
+    # producer CPU.  Pacing pays off when nothing else is holding the
+    # producer back.
+
+# target_latency is the knob to turn: a smaller target keeps the queue
+# shorter but gives the controller less room, so the rate saws up and down
+# more often around the consumer's real capacity
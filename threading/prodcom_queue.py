@@ -118,7 +118,7 @@ if __name__ == "__main__":
 # after a certain amount of time has passed -- you create a timer by 
 # passing in a number of seconds to wait and a function to call
 
-t = threading.Timer(30.0, my_function)
+    # t = threading.Timer(30.0, my_function)
 
 # You start the Timer by calling .start(), and the function will be called
 # on a new thread at some point after the specified time, but be aware
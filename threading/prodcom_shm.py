@@ -0,0 +1,346 @@
+# Producer-Consumer across processes using shared memory
+
+# prodcom_lock.py and prodcom_queue.py pass messages between threads, which
+# all live in the same process and so can just hand each other a reference.
+# Once the producer and consumer live in separate processes (to get around
+# the GIL, for example) the obvious tool is multiprocessing.Queue -- but every
+# .put() pickles the object, writes the bytes down a pipe, and every .get()
+# reads them back and unpickles them.  For a small int that is a lot of work.
+
+# Our messages are always small ints from random.randint(1, 101), so they fit
+# in a fixed-width slot.  multiprocessing.shared_memory gives both processes
+# the same block of memory, and we can lay a ring buffer over it:
+
+    # | head | ... padding ... | tail | ... padding ... | slot 0 | slot 1 | ...
+
+    # head counts how many messages the producer has written
+    # tail counts how many messages the consumer has read
+    # A message lives in slot (count % capacity)
+    # The buffer is empty when head == tail, and full when
+    # head - tail == capacity
+
+# With exactly one producer and one consumer, each counter only ever has one
+# writer, so no lock is needed.  The producer writes the slot *before* moving
+# head, and the consumer reads the slot *before* moving tail, so neither side
+# ever sees a half-written message.  head and tail are kept on separate cache
+# lines so that the two processes don't keep stealing the same line from each
+# other (false sharing).
+
+    # That ordering argument leans on the hardware.  Python has no memory
+    # barriers, so "write the slot, then write head" only means the other
+    # process sees them in that order on CPUs with strong memory ordering,
+    # like x86.  On ARM (and other weakly ordered CPUs) the store to head can
+    # become visible before the store to the slot, and the consumer could
+    # read a stale message.  Don't rely on this ring there.
+
+# Nothing is copied or pickled -- set_message() is one store into the slot and
+# one into head.  set_messages() and get_messages() move a whole batch with
+# one slice copy and a single update of head or tail, which is how to get
+# millions of messages per second out of it -- per message, the Python
+# function call costs far more than the transport does.  When the buffer is
+# full (or empty) the waiting side spins for a little while and then backs
+# off with short sleeps, which is much cheaper than a round trip through a
+# pipe or a kernel semaphore per message.
+
+import array
+import logging
+import multiprocessing
+import os
+import random
+import time
+from multiprocessing import shared_memory
+
+# The values are ints, so the SENTINEL has to be one as well -- pick one that
+# random.randint(1, 101) can never produce
+SENTINEL = -1
+
+_SLOT = 8           # bytes per message, a signed 64-bit int
+_LINE = 64          # bytes in a cache line
+_HEAD = 0           # index of head, in slots
+_TAIL = _LINE // _SLOT
+_DATA = 2 * _LINE // _SLOT
+
+
+def producer(pipeline, count=10):
+    """ Receives messages from the network.
+    """
+    for index in range(count):
+        message = random.randint(1, 101)
+        logging.info("Producer got message: %s", message)
+        pipeline.set_message(message, "Producer")
+
+    pipeline.set_message(SENTINEL, "Producer")
+
+
+def consumer(pipeline):
+    """ Saves numbers in the database.
+    """
+    message = 0
+    while message != SENTINEL:
+        message = pipeline.get_message("Consumer")
+        if message != SENTINEL:
+            logging.info("Consumer storing message: %s", message)
+
+
+class Pipeline:
+    """ Single producer, single consumer ring buffer of ints in shared memory.
+    """
+
+    def __init__(self, capacity=1024):
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1")
+        self.capacity = capacity
+        self._shm = shared_memory.SharedMemory(
+            create=True, size=(_DATA + capacity) * _SLOT)
+        # Only the creating process unlinks the block.  A forked child gets
+        # a copy of this object without going through __setstate__, so
+        # remember the pid rather than just a flag.
+        self._owner = os.getpid()
+        self._attach()
+        self._buf[_HEAD] = 0
+        self._buf[_TAIL] = 0
+
+    def _attach(self):
+        # A memoryview cast to 'q' lets us index the block as 64-bit ints
+        self._buf = self._shm.buf.cast("q")
+
+    # The Pipeline gets pickled when it is handed to multiprocessing.Process,
+    # so only send the name of the block across and reattach on the other side
+
+    def __getstate__(self):
+        return {"name": self._shm.name, "capacity": self.capacity}
+
+    def __setstate__(self, state):
+        self.capacity = state["capacity"]
+        # Child processes share the parent's resource tracker, so attaching
+        # here doesn't register the block a second time
+        self._shm = shared_memory.SharedMemory(name=state["name"])
+        self._owner = None
+        self._attach()
+
+    def _wait(self, spins):
+        # Spin first -- the other side is usually only a moment away -- and
+        # then back off so that a stalled peer doesn't burn a whole core
+        if spins < 100:
+            return
+        time.sleep(0 if spins < 1000 else 0.0001)
+
+    def set_message(self, message, name):
+        logging.debug("%s:about to add %d to ring", name, message)
+        buf = self._buf
+        head = buf[_HEAD]
+        spins = 0
+        while head - buf[_TAIL] >= self.capacity:
+            spins += 1
+            self._wait(spins)
+        buf[_DATA + head % self.capacity] = message
+        buf[_HEAD] = head + 1
+        logging.debug("%s:added %d to ring", name, message)
+
+    def get_message(self, name):
+        logging.debug("%s:about to get from ring", name)
+        buf = self._buf
+        tail = buf[_TAIL]
+        spins = 0
+        while buf[_HEAD] == tail:
+            spins += 1
+            self._wait(spins)
+        message = buf[_DATA + tail % self.capacity]
+        buf[_TAIL] = tail + 1
+        logging.debug("%s:got %d from ring", name, message)
+        return message
+
+    def set_messages(self, messages, name):
+        # Copies as many messages as fit straight into the ring, and only
+        # waits when the ring is completely full
+        logging.debug("%s:about to add %d messages to ring", name,
+                      len(messages))
+        buf, capacity = self._buf, self.capacity
+        data = array.array("q", messages)
+        sent = 0
+        while sent < len(data):
+            head = buf[_HEAD]
+            spins = 0
+            while head - buf[_TAIL] >= capacity:
+                spins += 1
+                self._wait(spins)
+            count = min(capacity - (head - buf[_TAIL]), len(data) - sent)
+            # The batch may wrap around the end of the ring
+            start = head % capacity
+            first = min(count, capacity - start)
+            buf[_DATA + start:_DATA + start + first] = data[sent:sent + first]
+            if count > first:
+                buf[_DATA:_DATA + count - first] = \
+                    data[sent + first:sent + count]
+            buf[_HEAD] = head + count
+            sent += count
+        logging.debug("%s:added %d messages to ring", name, len(messages))
+
+    def get_messages(self, name, limit=None):
+        # Waits for at least one message, then returns everything that is
+        # ready (up to limit) as a list
+        logging.debug("%s:about to get messages from ring", name)
+        buf, capacity = self._buf, self.capacity
+        tail = buf[_TAIL]
+        spins = 0
+        while buf[_HEAD] == tail:
+            spins += 1
+            self._wait(spins)
+        count = buf[_HEAD] - tail
+        if limit is not None:
+            count = min(count, limit)
+        start = tail % capacity
+        first = min(count, capacity - start)
+        messages = buf[_DATA + start:_DATA + start + first].tolist()
+        if count > first:
+            messages += buf[_DATA:_DATA + count - first].tolist()
+        buf[_TAIL] = tail + count
+        logging.debug("%s:got %d messages from ring", name, count)
+        return messages
+
+    def qsize(self):
+        return self._buf[_HEAD] - self._buf[_TAIL]
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def close(self):
+        # The memoryview has to be released before the block can be closed
+        if self._buf is None:
+            return
+        self._buf.release()
+        self._buf = None
+        self._shm.close()
+        if self._owner == os.getpid():
+            self._shm.unlink()
+
+    def __del__(self):
+        # Child processes never call .close(), but still need to let go of
+        # the block when they exit -- and if the process that created the
+        # block forgot to call .close(), it still has to be unlinked
+        if getattr(self, "_buf", None) is not None:
+            self.close()
+
+
+# BENCHMARK
+# Send the same stream of ints from one process to another and compare
+# messages per second: through the ring one message at a time with
+# set_message()/get_message(), through the ring in batches with
+# set_messages()/get_messages(), and through a multiprocessing.Queue.
+
+def _ring_send(pipeline, count):
+    for message in range(1, count + 1):
+        pipeline.set_message(message, "Producer")
+    pipeline.set_message(SENTINEL, "Producer")
+
+
+def _ring_receive(pipeline, result):
+    total = 0
+    while True:
+        message = pipeline.get_message("Consumer")
+        if message == SENTINEL:
+            break
+        total += message
+    result.value = total
+
+
+def _ring_send_batched(pipeline, count, batch=1024):
+    for first in range(1, count + 1, batch):
+        pipeline.set_messages(range(first, min(first + batch, count + 1)),
+                              "Producer")
+    pipeline.set_message(SENTINEL, "Producer")
+
+
+def _ring_receive_batched(pipeline, result):
+    total = 0
+    while True:
+        messages = pipeline.get_messages("Consumer")
+        if messages[-1] == SENTINEL:
+            total += sum(messages[:-1])
+            break
+        total += sum(messages)
+    result.value = total
+
+
+def _queue_send(q, count):
+    for message in range(1, count + 1):
+        q.put(message)
+    q.put(SENTINEL)
+
+
+def _queue_receive(q, result):
+    total = 0
+    while True:
+        message = q.get()
+        if message == SENTINEL:
+            break
+        total += message
+    result.value = total
+
+
+def _run(send, receive, transport, count):
+    result = multiprocessing.Value("q", 0)
+    workers = [
+        multiprocessing.Process(target=receive, args=(transport, result)),
+        multiprocessing.Process(target=send, args=(transport, count)),
+    ]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    assert result.value == count * (count + 1) // 2
+    return count / elapsed
+
+
+def benchmark(count=1_000_000, capacity=4096):
+    rates = {}
+    for label, send, receive in (
+            ("ring, one at a time", _ring_send, _ring_receive),
+            ("ring, batched", _ring_send_batched, _ring_receive_batched)):
+        pipeline = Pipeline(capacity)
+        try:
+            rates[label] = _run(send, receive, pipeline, count)
+        finally:
+            pipeline.close()
+    queue_rate = _run(_queue_send, _queue_receive,
+                      multiprocessing.Queue(capacity), count)
+    for label, rate in rates.items():
+        logging.info("%-21s: %10.0f msgs/s, %5.1fx multiprocessing.Queue",
+                     label, rate, rate / queue_rate)
+    logging.info("%-21s: %10.0f msgs/s", "multiprocessing.Queue", queue_rate)
+
+
+if __name__ == "__main__":
+    format = "%(asctime)s: %(message)s"
+    logging.basicConfig(format=format, level=logging.INFO,
+                        datefmt="%H:%M:%S")
+
+    pipeline = Pipeline()
+    try:
+        workers = [
+            multiprocessing.Process(target=producer, args=(pipeline,)),
+            multiprocessing.Process(target=consumer, args=(pipeline,)),
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    finally:
+        pipeline.close()
+
+    benchmark()
+
+# The producer and consumer above are the same functions as in
+# prodcom_lock.py -- only the Pipeline changed, and the Pipeline is now
+# shared between processes rather than threads
+
+# This only works because every message is the same size.  Anything that
+# needs pickling (strings, dicts, objects) would still have to go through a
+# multiprocessing.Queue, or be encoded into fixed-width records first
+
+# With more than one producer or more than one consumer, head or tail would
+# have more than one writer and would need a lock (or an atomic
+# compare-and-swap, which Python doesn't give us) -- use one ring per
+# producer/consumer pair instead
@@ -0,0 +1,240 @@
+# Readers-writer lock and copy-on-write snapshots
+
+# racecond.py's FakeDatabase guards .update() with a Lock, which is right for
+# writes -- only one thread may be in the read-modify-write section at a time.
+# But anything that just wants to read .value would have to take the same
+# Lock to be sure it isn't seeing a half-finished update, and then readers
+# queue up behind each other even though reads can't race with each other.
+# When 95% of the work is reads, that Lock is the bottleneck.
+
+# A READERS-WRITER LOCK has two modes:
+    # Any number of readers may hold it at once
+    # A writer holds it alone -- no readers, no other writers
+
+# If readers keep arriving, there may never be a moment with zero readers,
+# and a writer could wait forever (starvation).  This one prefers writers:
+# once a writer is waiting, new readers wait behind it, the readers already
+# inside finish up, and the writer goes next.
+
+# COPY-ON-WRITE SNAPSHOTS go one step further and never make readers wait.
+# The data lives in an object that is never modified once published.  A
+# writer (still under a Lock, so writers don't race each other) builds a new
+# copy with its change and then swaps the reference in one assignment.
+# Rebinding an attribute is atomic in Python, so a reader sees either the old
+# snapshot or the new one, never half of each.  The price is a copy per write.
+
+import concurrent.futures
+import logging
+import threading
+import time
+
+
+class RWLock:
+    """ A readers-writer lock that prefers waiting writers.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+
+    def acquire_read(self):
+        with self._condition:
+            while self._writer or self._writers_waiting:
+                self._condition.wait()
+            self._readers += 1
+
+    def release_read(self):
+        with self._condition:
+            self._readers -= 1
+            if self._readers == 0:
+                self._condition.notify_all()
+
+    def acquire_write(self):
+        with self._condition:
+            self._writers_waiting += 1
+            try:
+                while self._writer or self._readers:
+                    self._condition.wait()
+            except BaseException:
+                # The wait was interrupted (KeyboardInterrupt, say).  This
+                # writer is no longer waiting, so let any readers it was
+                # holding back go ahead, or they would wait forever.
+                self._writers_waiting -= 1
+                self._condition.notify_all()
+                raise
+            self._writers_waiting -= 1
+            self._writer = True
+
+    def release_write(self):
+        with self._condition:
+            self._writer = False
+            self._condition.notify_all()
+
+    # Like Lock, these work in a with statement, so an exception can't skip
+    # the release
+
+    def read_lock(self):
+        return _Held(self.acquire_read, self.release_read)
+
+    def write_lock(self):
+        return _Held(self.acquire_write, self.release_write)
+
+
+class _Held:
+    def __init__(self, acquire, release):
+        self._acquire = acquire
+        self._release = release
+
+    def __enter__(self):
+        self._acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._release()
+
+
+class FakeDatabase:
+    """ racecond.FakeDatabase, with reads that don't block each other.
+
+    mode="rwlock" guards value with an RWLock; mode="snapshot" publishes an
+    immutable copy of the data on every write so that readers never block.
+    """
+
+    modes = ("rwlock", "snapshot")
+
+    def __init__(self, mode="rwlock", work=0.0):
+        if mode not in self.modes:
+            raise ValueError("mode must be one of {}".format(self.modes))
+        self.mode = mode
+        # Time spent inside the lock per operation, like the sleep(0.1) in
+        # racecond.py
+        self.work = work
+        self._rwlock = RWLock()
+        self._write_lock = threading.Lock()
+        self._snapshot = (0,)
+
+    @property
+    def value(self):
+        return self._snapshot[0]
+
+    def read(self, name):
+        logging.debug("Thread %s: starting read", name)
+        if self.mode == "snapshot":
+            # One attribute read -- whichever snapshot is current right now
+            snapshot = self._snapshot
+            if self.work:
+                time.sleep(self.work)
+            return snapshot[0]
+        with self._rwlock.read_lock():
+            value = self._snapshot[0]
+            if self.work:
+                time.sleep(self.work)
+        return value
+
+    def update(self, name):
+        logging.debug("Thread %s: starting update", name)
+        if self.mode == "snapshot":
+            with self._write_lock:
+                local_copy = list(self._snapshot)
+                local_copy[0] += 1
+                if self.work:
+                    time.sleep(self.work)
+                self._snapshot = tuple(local_copy)
+        else:
+            with self._rwlock.write_lock():
+                local_copy = self._snapshot[0]
+                local_copy += 1
+                if self.work:
+                    time.sleep(self.work)
+                self._snapshot = (local_copy,)
+        logging.debug("Thread %s: finishing update", name)
+
+
+class LockedDatabase(FakeDatabase):
+    """ The racecond.py approach -- one Lock for reads and writes alike.
+    """
+
+    modes = ("lock",)
+
+    def __init__(self, work=0.0):
+        super().__init__("lock", work)
+        self._lock = threading.Lock()
+
+    def read(self, name):
+        with self._lock:
+            value = self._snapshot[0]
+            if self.work:
+                time.sleep(self.work)
+        return value
+
+    def update(self, name):
+        with self._lock:
+            local_copy = self._snapshot[0] + 1
+            if self.work:
+                time.sleep(self.work)
+            self._snapshot = (local_copy,)
+
+
+# BENCHMARK
+# A 95% read / 5% write mix, spread over more and more threads.  Each
+# operation holds its lock for a short sleep, standing in for I/O -- which is
+# where threads pay off, since the GIL is released while they wait.  At the
+# end every update must be accounted for in value.
+
+def _worker(database, ops, write_every):
+    for index in range(ops):
+        if index % write_every == 0:
+            database.update(index)
+        else:
+            database.read(index)
+
+
+def benchmark(ops=400, work=0.0005, write_every=20):
+    for threads in (1, 2, 4, 8):
+        results = []
+        for label, database in (("lock", LockedDatabase(work)),
+                                ("rwlock", FakeDatabase("rwlock", work)),
+                                ("snapshot", FakeDatabase("snapshot", work))):
+            start = time.perf_counter()
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=threads) as executor:
+                for _ in range(threads):
+                    executor.submit(_worker, database, ops, write_every)
+            elapsed = time.perf_counter() - start
+            writes = threads * len(range(0, ops, write_every))
+            assert database.value == writes, (label, database.value, writes)
+            results.append("{} {:7.0f} ops/s".format(
+                label, threads * ops / elapsed))
+        logging.info("%d threads: %s", threads, ", ".join(results))
+
+
+if __name__ == "__main__":
+    format = "%(asctime)s: %(message)s"
+    logging.basicConfig(format=format, level=logging.INFO,
+                        datefmt="%H:%M:%S")
+
+    for mode in ("rwlock", "snapshot"):
+        database = FakeDatabase(mode, work=0.1)
+        logging.info("Testing %s.  Starting value is %d.", mode,
+                     database.value)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+            executor.submit(database.update, 0)
+            for index in range(1, 4):
+                executor.submit(database.read, index)
+        logging.info("Testing %s. Ending value is %d.", mode, database.value)
+
+    benchmark()
+
+# The value is kept in a one-element tuple so both modes share the same
+# storage -- in the snapshot mode a real database would publish a whole
+# frozen dict or tuple of rows the same way
+
+# Snapshot reads can be stale: a reader that grabbed the old snapshot a
+# moment before a write finishes will return the old value.  That is the
+# same as a reader that took the read lock just before the writer did, but
+# with snapshots it can happen while the write is still in progress
+
+# Writer preference means a steady stream of writers can starve readers
+# instead -- with 5% writes that isn't a concern here
@@ -0,0 +1,253 @@
+# A single-thread timer service
+
+# The notes in prodcom_queue.py show threading.Timer(30.0, my_function).
+# Under the hood every Timer is a whole Thread that sleeps until it is due.
+# That is fine for one or two, but a server that schedules a retry or a
+# timeout per request can easily have thousands pending, and thousands of
+# OS threads means thousands of stacks and a scheduler with a lot to do.
+
+# A timer service runs every deferred call from one thread instead:
+
+    # Pending timers live in a heap (heapq) ordered by when they are due,
+    # so the next one to fire is always heap[0], and adding one is O(log n)
+
+    # The service thread waits on a Condition until heap[0] is due, or until
+    # someone schedules an earlier timer and wakes it up with .notify()
+
+    # .cancel() just marks the timer as cancelled -- O(1) -- and the service
+    # thread throws it away when it reaches the top of the heap ("lazy
+    # deletion").  Digging it out of the middle of the heap would be O(n).
+    # If cancelled timers ever make up most of the heap, it is rebuilt
+    # without them so they can't pile up.
+
+# All callbacks run on the service thread, so one slow callback delays every
+# timer behind it.  Pass an executor and the service thread only hands
+# callbacks off to it, and goes straight back to watching the clock.
+
+import concurrent.futures
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+
+class Timer:
+    """ A call to function(*args, **kwargs) after interval seconds.
+    """
+
+    def __init__(self, service, interval, function, args=None, kwargs=None):
+        self.service = service
+        self.interval = interval
+        self.function = function
+        self.args = args if args is not None else []
+        self.kwargs = kwargs if kwargs is not None else {}
+        self.started = False
+        self.cancelled = False
+        self.finished = False
+
+    def start(self):
+        self.service._schedule(self)
+
+    def cancel(self):
+        # Like threading.Timer, cancelling a timer that already ran (or was
+        # already cancelled) is not an error
+        self.service._cancel(self)
+
+    def run(self):
+        self.function(*self.args, **self.kwargs)
+
+
+class TimerService:
+    """ Runs Timer callbacks from one thread, in the order they are due.
+    """
+
+    def __init__(self, executor=None):
+        self.executor = executor
+        self._heap = []
+        self._cancelled_count = 0
+        # Tie breaker, so timers due at the same time fire in start() order
+        # and heapq never has to compare two Timer objects
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name="TimerService")
+        self._thread.start()
+
+    def timer(self, interval, function, args=None, kwargs=None):
+        return Timer(self, interval, function, args, kwargs)
+
+    def call_later(self, interval, function, *args, **kwargs):
+        timer = self.timer(interval, function, args, kwargs)
+        timer.start()
+        return timer
+
+    def pending(self):
+        with self._condition:
+            return len(self._heap) - self._cancelled_count
+
+    def _schedule(self, timer):
+        when = time.monotonic() + timer.interval
+        with self._condition:
+            if self._stopped:
+                raise RuntimeError("TimerService has been shut down")
+            if timer.started:
+                raise RuntimeError("timers can only be started once")
+            timer.started = True
+            if timer.cancelled:
+                # Cancelled before it was started, just like threading.Timer
+                return
+            heapq.heappush(self._heap, (when, next(self._counter), timer))
+            # Only the new earliest timer changes how long the thread sleeps
+            if self._heap[0][2] is timer:
+                self._condition.notify()
+
+    def _cancel(self, timer):
+        with self._condition:
+            if timer.cancelled or timer.finished:
+                return
+            timer.cancelled = True
+            if not timer.started:
+                return
+            self._cancelled_count += 1
+            if self._cancelled_count > len(self._heap) // 2:
+                self._heap = [entry for entry in self._heap
+                              if not entry[2].cancelled]
+                heapq.heapify(self._heap)
+                self._cancelled_count = 0
+
+    def _next_due(self):
+        # Called with the condition held.  Returns a timer that is due, or
+        # None once the service is stopped.
+        while not self._stopped:
+            if not self._heap:
+                self._condition.wait()
+                continue
+            when, _, timer = self._heap[0]
+            if timer.cancelled:
+                heapq.heappop(self._heap)
+                self._cancelled_count -= 1
+                continue
+            delay = when - time.monotonic()
+            if delay > 0:
+                self._condition.wait(delay)
+                continue
+            heapq.heappop(self._heap)
+            # Mark it under the lock, so a racing .cancel() sees it has run
+            timer.finished = True
+            return timer
+        return None
+
+    def _run(self):
+        while True:
+            with self._condition:
+                timer = self._next_due()
+            if timer is None:
+                return
+            try:
+                if self.executor is not None:
+                    # Nobody else ever looks at this future, so an exception
+                    # raised by the callback would vanish with it
+                    future = self.executor.submit(timer.run)
+                    future.add_done_callback(
+                        lambda f, function=timer.function:
+                            self._log_failure(function, f))
+                else:
+                    timer.run()
+            except Exception:
+                logging.exception("TimerService: callback %s failed",
+                                  timer.function)
+
+    @staticmethod
+    def _log_failure(function, future):
+        if future.cancelled():
+            return
+        exc = future.exception()
+        if exc is not None:
+            logging.error("TimerService: callback %s failed", function,
+                          exc_info=exc)
+
+    def shutdown(self, wait=True):
+        # Timers that haven't fired yet are dropped
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        if wait:
+            self._thread.join()
+
+
+# BENCHMARK
+# Schedule 10,000 callbacks half a second out, once as threading.Timer
+# objects and once on the service, and compare how long scheduling took, how
+# many threads were alive afterwards, and when the last callback ran.
+
+def _benchmark_one(label, start_timer, count, interval):
+    done = threading.Event()
+    fired = [0]
+    lock = threading.Lock()
+
+    def callback():
+        with lock:
+            fired[0] += 1
+            if fired[0] == count:
+                done.set()
+
+    start = time.perf_counter()
+    for index in range(count):
+        try:
+            start_timer(interval, callback)
+        except RuntimeError as e:
+            # "can't start new thread" -- the thread limit was hit
+            logging.warning("%-15s: failed after %d timers: %s",
+                            label, index, e)
+            return
+    scheduled = time.perf_counter() - start
+    threads = threading.active_count()
+    done.wait()
+    finished = time.perf_counter() - start
+    logging.warning("%-15s: scheduled in %.3fs, %5d threads alive, "
+                    "last callback at %.3fs (due at %.3fs)",
+                    label, scheduled, threads, finished, interval)
+
+
+def _start_thread_timer(interval, callback):
+    threading.Timer(interval, callback).start()
+
+
+def benchmark(count=10000, interval=0.5):
+    _benchmark_one("threading.Timer", _start_thread_timer, count, interval)
+    service = TimerService()
+    _benchmark_one("TimerService", service.call_later, count, interval)
+    service.shutdown()
+
+
+def say(name):
+    logging.info("Timer %s: fired", name)
+
+
+if __name__ == "__main__":
+    format = "%(asctime)s: %(message)s"
+    logging.basicConfig(format=format, level=logging.INFO,
+                        datefmt="%H:%M:%S")
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        service = TimerService(executor)
+        for index in range(3):
+            logging.info("Main    : start timer %d", index)
+            service.timer(0.5 * (3 - index), say, args=(index,)).start()
+        t = service.timer(0.2, say, args=("cancelled",))
+        t.start()
+        t.cancel()
+        time.sleep(2)
+        service.shutdown()
+
+    benchmark()
+
+# service.timer(30.0, my_function) is a drop-in for
+# threading.Timer(30.0, my_function) -- create it, .start() it, and .cancel()
+# it if you change your mind.  Like threading.Timer, there is no promise that
+# the callback runs exactly on time, only that it doesn't run early.
+
+# The service thread is a daemon, so pending timers don't keep the program
+# alive -- call .shutdown() to stop it explicitly.